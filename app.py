@@ -1,6 +1,19 @@
 import streamlit as st
 from openai import OpenAI
+import contextlib
+import copy
+import hashlib
+import hmac
+import html
 import json
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 
 # =============== 基础配置 ===============
 st.set_page_config(
@@ -12,12 +25,29 @@ st.set_page_config(
 # =============== Session State 初始化 ===============
 def init_state():
     defaults = {
+        "project_id": "",               # 项目 id，随存档导出/导入，生成日志按它分开
         "outline_raw": "",              # 完整大纲
         "outline_chapter_list": "",     # 章节目录（第1章 xxx —— 简介）
         "chapter_plans": {},            # {int: str} 各章细纲（可选）
+        "chapter_titles": {},           # {int: str} 各章标题（随项目保存，生成日志的 prompt 哈希依赖它）
         "chapter_texts": {},            # {int: str} 各章正文
         "chapter_highlights": {},       # {int: str} 各章亮点
         "last_chapter": 1,              # 最近一次写作的章节编号
+        "text_versions": {},            # {int: int} 各章正文版本号（乐观锁用）
+        # --- 全书统计索引（每次写入章节时增量维护） ---
+        "stats_index": {
+            "chapters": {},             # {int: int} 各章字数
+            "total": 0,                 # 全书字数
+            "target_label": "1500字左右",  # 全书统一的单章目标（不跟随各人的单轮生成设置）
+            "target": [1300, 1800],     # 由 target_label 解析出的单章目标字数区间
+            "under_target": {},         # {int: int} 已写但低于目标下限的章节
+            "written": 0,               # 已写（字数 > 0）的章节数
+            "stages": [],               # [[阶段名, 起始章, 结束章], ...] 从大纲“阶段划分”一节解析
+            "stage_totals": [],         # 与 stages 按下标一一对应的字数（阶段名可能重复，不能当 key）
+            "outline_chapters": 0,      # 章节目录里的总章数
+            "outline_src": None,        # 上次解析阶段/目录时的大纲原文，用来判断是否要重算
+            "list_src": None
+        },
         # --- 剧情记忆库 ---
         "story_memory": {
             "chapter_summaries": {},    # {int: str} 每章摘要
@@ -31,15 +61,240 @@ def init_state():
                 st.session_state[k] = json.loads(json.dumps(v, ensure_ascii=False))
             else:
                 st.session_state[k] = v
+    # 随机 id 不能写进 defaults，否则所有会话都是同一个
+    if not st.session_state.project_id:
+        st.session_state.project_id = uuid.uuid4().hex[:12]
+    if "session_id" not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex[:8]
 
 init_state()
 
+# =============== 共享工作区（多人协作同一本书） ===============
+# 同一进程里的所有浏览器会话按工作区名共享一份项目数据：dict 类字段直接引用同一个对象，
+# 不再每个标签页各存一份；章节正文按版本号做乐观锁，写入时发变更通知。
+# 每次写入后整份落盘到 novel_workspaces/<名称>.json，进程重启或缓存淘汰后从磁盘读回。
+SHARED_KEYS = [
+    "project_id", "outline_raw", "outline_chapter_list", "chapter_plans", "chapter_titles", "chapter_texts",
+    "chapter_highlights", "story_memory", "stats_index", "text_versions",
+]
+WORKSPACE_DIR = "novel_workspaces"
+WORKSPACE_CACHE_SIZE = 32   # 进程里最多同时缓存的工作区数，淘汰的下次用到时从磁盘读回
+
+def _int_keys(obj):
+    """JSON 只能存字符串 key，读回来时把纯数字的 key（章节号）还原成 int。"""
+    if isinstance(obj, dict):
+        return {int(k) if k.isdigit() else k: _int_keys(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_int_keys(v) for v in obj]
+    return obj
+
+class SharedWorkspace:
+    def __init__(self, name: str):
+        self.name = name
+        self.lock = threading.RLock()
+        self.state = {}     # SHARED_KEYS -> 值，首个加入的会话负责初始化
+        self.events = []    # [{"seq", "session", "author", "chapter", "what", "ts"}]
+        self.seq = 0
+        self.derived = {}   # prompt 哈希 -> 派生结果（章节摘要、目录抽取），只在本工作区内复用
+        self.path = os.path.join(WORKSPACE_DIR, f"{name}.json")
+        self.salt = ""
+        self.secret = ""    # 口令的 PBKDF2 摘要，首个加入的人设定
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self.salt = data.get("salt", "")
+            self.secret = data.get("secret", "")
+            self.state = _int_keys(data.get("state", {}))
+            if "stats_index" in self.state:
+                # 阶段划分、目录章数是从大纲派生的，读回后让 sync_stats_config 重算一遍
+                self.state["stats_index"]["outline_src"] = None
+                self.state["stats_index"]["list_src"] = None
+
+    def _digest(self, secret: str) -> str:
+        return hashlib.pbkdf2_hmac("sha256", secret.encode("utf-8"), bytes.fromhex(self.salt), 100_000).hex()
+
+    def admit(self, secret: str) -> bool:
+        """口令校验。工作区还没有口令时，由第一个加入的人设定。"""
+        if not secret:
+            return False
+        with self.lock:
+            if not self.secret:
+                self.salt = os.urandom(16).hex()
+                self.secret = self._digest(secret)
+                return True
+            return hmac.compare_digest(self._digest(secret), self.secret)
+
+    def save(self):
+        """写穿到磁盘：先写临时文件再替换，中途退出不会留下半个文件。整个过程持锁，新旧快照不会互相覆盖。"""
+        with self.lock:
+            os.makedirs(WORKSPACE_DIR, exist_ok=True)
+            tmp = self.path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"salt": self.salt, "secret": self.secret, "state": self.state}, f, ensure_ascii=False)
+            os.replace(tmp, self.path)
+
+    def publish(self, session: str, author: str, what: str, chapter: int = None):
+        with self.lock:
+            self.seq += 1
+            self.events.append({"seq": self.seq, "session": session, "author": author,
+                                "chapter": chapter, "what": what, "ts": time.time()})
+            del self.events[:-200]
+
+    def events_since(self, seq: int, session: str) -> list:
+        return [e for e in self.events if e["seq"] > seq and e["session"] != session]
+
+@st.cache_resource(max_entries=WORKSPACE_CACHE_SIZE)
+def get_workspace(name: str) -> SharedWorkspace:
+    return SharedWorkspace(name)
+
+def current_workspace():
+    name = st.session_state.get("workspace_name")
+    return get_workspace(name) if name else None
+
+def state_lock():
+    ws = current_workspace()
+    return ws.lock if ws else contextlib.nullcontext()
+
+def persist():
+    ws = current_workspace()
+    if ws:
+        ws.save()
+
+def notify(what: str, chapter: int = None):
+    """共享数据的每次写入都会走到这里：先落盘，再通知其他成员。"""
+    ws = current_workspace()
+    if ws:
+        ws.save()
+        ws.publish(st.session_state.session_id, st.session_state.get("author_name") or "匿名", what, chapter)
+
+def snapshot(d: dict) -> dict:
+    """
+    在锁内浅拷贝一份共享 dict 再遍历。工作区里这些 dict 会被其他会话的线程改动，
+    直接遍历可能抛 “dictionary changed size during iteration”。
+    """
+    with state_lock():
+        return dict(d)
+
+def has_project_content() -> bool:
+    return bool(
+        st.session_state.outline_raw.strip()
+        or st.session_state.outline_chapter_list.strip()
+        or any(t.strip() for t in snapshot(st.session_state.chapter_texts).values())
+    )
+
+def attach_workspace(name: str, secret: str = "") -> bool:
+    """
+    加入/切换工作区，口令不对时不切换并返回 False。每次重跑都会重新绑定一次共享数据，
+    工作区对象被缓存淘汰、从磁盘重新读回后，各会话也会自动指向新的那份。
+    工作区是空的就用当前会话的数据初始化；
+    加入已有内容的工作区前，先把个人模式下的项目备份到 private_backup；
+    退出工作区时把共享数据深拷贝一份留在本会话（拷贝时持有原工作区的锁），
+    并换一个新的 project_id，这份拷贝和原工作区从此是两个项目，生成日志、导出目录都不再混用；
+    用它去初始化另一个新工作区时带过去的也是这个新 id。
+    """
+    prev = st.session_state.get("workspace_name")
+    if name and name != prev and not get_workspace(name).admit(secret):
+        return False
+    if prev and prev != name:
+        with get_workspace(prev).lock:
+            for k in SHARED_KEYS:
+                st.session_state[k] = copy.deepcopy(st.session_state[k])
+        st.session_state.project_id = uuid.uuid4().hex[:12]
+    st.session_state.workspace_name = name
+    ws = current_workspace()
+    if ws is None:
+        return True
+    if prev != name:
+        st.session_state.ws_seen_seq = ws.seq  # 只提示加入之后的改动
+    with ws.lock:
+        if not ws.state:
+            ws.state = {k: copy.deepcopy(st.session_state[k]) for k in SHARED_KEYS}
+            ws.save()
+        elif not prev and has_project_content():
+            st.session_state.private_backup = export_project()
+        for k in SHARED_KEYS:
+            st.session_state[k] = ws.state[k]
+    return True
+
+def set_shared_value(key: str, value):
+    """大纲这类整段文本字段的写入，变了才推给工作区。"""
+    st.session_state[key] = value
+    ws = current_workspace()
+    if ws and ws.state.get(key) != value:
+        with ws.lock:
+            ws.state[key] = value
+        notify("更新了大纲" if key == "outline_raw" else "更新了章节目录")
+
+def _set_entry(container: dict, key, value, what: str, chapter: int = None):
+    with state_lock():
+        if container.get(key) == value:
+            return
+        container[key] = value
+    notify(what, chapter)
+
+def set_chapter_summary(chap: int, text: str):
+    _set_entry(st.session_state.story_memory["chapter_summaries"], chap, text, f"更新了第{chap}章摘要", chap)
+
+def set_chapter_highlight(chap: int, text: str):
+    _set_entry(st.session_state.chapter_highlights, chap, text, f"更新了第{chap}章亮点", chap)
+
+def set_global_summary(text: str):
+    _set_entry(st.session_state.story_memory, "global_summary", text, "更新了全局摘要")
+
+def synced_text_area(label: str, key: str, current: str, on_edit, **kwargs) -> str:
+    """
+    绑定共享条目的编辑框：只有用户真的改动时（on_change）才调用 on_edit 写回，
+    不会在每次刷新时把本会话手里的旧值写回去；共享值被别人或生成流程改了，
+    就在渲染前把编辑框刷新成最新值。
+    """
+    seen_key = key + "__seen"
+    if key not in st.session_state or st.session_state.get(seen_key) != current:
+        st.session_state[key] = current
+        st.session_state[seen_key] = current
+
+    def _save():
+        value = st.session_state[key]
+        st.session_state[seen_key] = value
+        on_edit(value)
+
+    return st.text_area(label, key=key, on_change=_save, **kwargs)
+
+def push_project_to_workspace():
+    """导入项目后，用本会话的数据整体替换工作区。"""
+    ws = current_workspace()
+    if ws is None:
+        return
+    with ws.lock:
+        for k in SHARED_KEYS:
+            ws.state[k] = st.session_state[k]
+    notify("导入了新的项目存档")
+
+# =============== 进程级派生结果缓存（所有会话共享） ===============
+OUTLINE_LINE_RE = re.compile(r"\s*第\s*(\d+)\s*章")
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def parse_outline_table(outline_list: str) -> dict:
+    """章节目录解析成 {章号: 目录行}，同一份目录只解析一次。"""
+    table = {}
+    for line in outline_list.splitlines():
+        m = OUTLINE_LINE_RE.match(line)
+        if m:
+            table.setdefault(int(m.group(1)), line.strip())
+    return table
+
 # =============== 导出 / 导入函数（包含记忆库） ===============
 def export_project() -> str:
-    data = {
+    with state_lock():
+        data = _project_data()
+    return json.dumps(data, ensure_ascii=False, indent=2)
+
+def _project_data() -> dict:
+    return {
+        "project_id": st.session_state.project_id,
         "outline_raw": st.session_state.outline_raw,
         "outline_chapter_list": st.session_state.outline_chapter_list,
         "chapter_plans": {str(k): v for k, v in st.session_state.chapter_plans.items()},
+        "chapter_titles": {str(k): v for k, v in st.session_state.chapter_titles.items()},
         "chapter_texts": {str(k): v for k, v in st.session_state.chapter_texts.items()},
         "chapter_highlights": {str(k): v for k, v in st.session_state.chapter_highlights.items()},
         "story_memory": {
@@ -47,7 +302,6 @@ def export_project() -> str:
             "global_summary": st.session_state.story_memory.get("global_summary", "")
         }
     }
-    return json.dumps(data, ensure_ascii=False, indent=2)
 
 def import_project(json_str: str):
     try:
@@ -56,8 +310,16 @@ def import_project(json_str: str):
         st.error(f"导入失败：JSON 解析错误 - {e}")
         return
 
+    st.session_state.project_id = data.get("project_id") or uuid.uuid4().hex[:12]
     st.session_state.outline_raw = data.get("outline_raw", "")
     st.session_state.outline_chapter_list = data.get("outline_chapter_list", "")
+    # 所有章节的版本号统一换成比以往任何版本都大的新号，各会话的编辑框会载入导入后的正文；
+    # 只给每章各自 +1 的话，某章旧版本号可能恰好等于别处编辑框记着的版本，乐观锁就失效了
+    old_versions = snapshot(st.session_state.text_versions)
+    new_version = max(old_versions.values(), default=0) + 1
+    st.session_state.text_versions = {
+        c: new_version for c in set(old_versions) | {int(k) for k in data.get("chapter_texts", {})}
+    }
 
     cp = data.get("chapter_plans", {})
     ct = data.get("chapter_texts", {})
@@ -65,7 +327,10 @@ def import_project(json_str: str):
     sm = data.get("story_memory", {})
 
     st.session_state.chapter_plans = {int(k): v for k, v in cp.items()}
+    st.session_state.chapter_titles = {int(k): v for k, v in data.get("chapter_titles", {}).items()}
     st.session_state.chapter_texts = {int(k): v for k, v in ct.items()}
+    with state_lock():
+        rebuild_stats_index(recount=True)
     st.session_state.chapter_highlights = {int(k): v for k, v in ch.items()}
 
     # 记忆库
@@ -81,6 +346,327 @@ def import_project(json_str: str):
     else:
         st.session_state.last_chapter = 1
 
+    push_project_to_workspace()
+
+# =============== 整本书导出（TXT / Markdown / EPUB） ===============
+# 每章单独渲染成片段文件缓存在磁盘上，只有内容或标题变了的章节才重新渲染；
+# 成书时按章节顺序把片段逐个拷进输出文件，不在内存里拼整本书。
+BOOK_EXPORT_DIR = "book_export"
+BOOK_FORMATS = {"TXT": "txt", "Markdown": "md", "EPUB": "epub"}
+
+def book_export_dir() -> str:
+    """每个项目一份目录，片段缓存跟着书走，换会话、换工作区名都能复用。"""
+    return os.path.join(BOOK_EXPORT_DIR, st.session_state.project_id)
+
+@st.cache_resource
+def project_export_lock(project_id: str) -> threading.Lock:
+    """同一项目的导出串行进行，几个会话同时导出也不会交错写同一批片段和成书文件。"""
+    return threading.Lock()
+
+def outline_title_for_chapter(chap: int) -> str:
+    """从章节目录里取“第X章 章节名”，去掉“——”后面的简介；目录里没有就只用章节号。"""
+    line = parse_outline_table(st.session_state.outline_chapter_list or "").get(chap)
+    return line.split("——")[0].strip() if line else f"第{chap}章"
+
+def render_chapter(fmt: str, title: str, text: str) -> str:
+    paragraphs = [p.strip() for p in text.splitlines() if p.strip()]
+    if fmt == "txt":
+        return title + "\n\n" + "\n\n".join(paragraphs) + "\n\n\n"
+    if fmt == "md":
+        return f"## {title}\n\n" + "\n\n".join(paragraphs) + "\n\n"
+    body = "\n".join(f"<p>{html.escape(p)}</p>" for p in paragraphs)
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>\n'
+        '<!DOCTYPE html>\n'
+        '<html xmlns="http://www.w3.org/1999/xhtml" xml:lang="zh-CN">\n'
+        f"<head><title>{html.escape(title)}</title></head>\n"
+        f"<body>\n<h2>{html.escape(title)}</h2>\n{body}\n</body>\n</html>\n"
+    )
+
+def refresh_chapter_fragments(fmt: str, chapters: list) -> tuple:
+    """
+    把需要导出的章节渲染成片段文件，返回 (片段路径列表, 本次重新渲染的章数)。
+    manifest.json 记录每章上次渲染时的内容哈希。
+    """
+    frag_dir = os.path.join(book_export_dir(), fmt)
+    os.makedirs(frag_dir, exist_ok=True)
+    manifest_path = os.path.join(frag_dir, "manifest.json")
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, encoding="utf-8") as f:
+            manifest = json.load(f)
+
+    ext = "xhtml" if fmt == "epub" else fmt
+    paths, rendered = [], 0
+    for chap in chapters:
+        title = outline_title_for_chapter(chap)
+        text = st.session_state.chapter_texts[chap]
+        digest = hashlib.sha256(f"{title}\n{text}".encode("utf-8")).hexdigest()[:16]
+        path = os.path.join(frag_dir, f"chap_{chap:04d}.{ext}")
+        if manifest.get(str(chap)) != digest or not os.path.exists(path):
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(render_chapter(fmt, title, text))
+            manifest[str(chap)] = digest
+            rendered += 1
+        paths.append(path)
+
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    return paths, rendered
+
+def write_epub(out_path: str, book_title: str, chapters: list, paths: list):
+    book_id = uuid.uuid5(uuid.NAMESPACE_URL, "novelfactory:" + book_title)
+    modified = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    names = [os.path.basename(p) for p in paths]
+    manifest_items = "\n".join(
+        f'<item id="c{chap}" href="text/{name}" media-type="application/xhtml+xml"/>'
+        for chap, name in zip(chapters, names)
+    )
+    spine_items = "\n".join(f'<itemref idref="c{chap}"/>' for chap in chapters)
+    nav_items = "\n".join(
+        f'<li><a href="text/{name}">{html.escape(outline_title_for_chapter(chap))}</a></li>'
+        for chap, name in zip(chapters, names)
+    )
+    opf = f"""<?xml version="1.0" encoding="utf-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="bookid">
+<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+<dc:identifier id="bookid">urn:uuid:{book_id}</dc:identifier>
+<dc:title>{html.escape(book_title)}</dc:title>
+<dc:language>zh-CN</dc:language>
+<meta property="dcterms:modified">{modified}</meta>
+</metadata>
+<manifest>
+<item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>
+{manifest_items}
+</manifest>
+<spine>
+{spine_items}
+</spine>
+</package>
+"""
+    nav = f"""<?xml version="1.0" encoding="utf-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" xml:lang="zh-CN">
+<head><title>{html.escape(book_title)}</title></head>
+<body>
+<nav epub:type="toc"><h1>目录</h1>
+<ol>
+{nav_items}
+</ol>
+</nav>
+</body>
+</html>
+"""
+    container = """<?xml version="1.0" encoding="utf-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+<rootfiles>
+<rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>
+</rootfiles>
+</container>
+"""
+    with zipfile.ZipFile(out_path, "w") as zf:
+        # mimetype 必须是第一个且不压缩
+        zf.writestr("mimetype", "application/epub+zip", compress_type=zipfile.ZIP_STORED)
+        zf.writestr("META-INF/container.xml", container, compress_type=zipfile.ZIP_DEFLATED)
+        zf.writestr("OEBPS/content.opf", opf, compress_type=zipfile.ZIP_DEFLATED)
+        zf.writestr("OEBPS/nav.xhtml", nav, compress_type=zipfile.ZIP_DEFLATED)
+        for path, name in zip(paths, names):
+            zf.write(path, f"OEBPS/text/{name}", compress_type=zipfile.ZIP_DEFLATED)
+
+def export_book(fmt: str, book_title: str) -> tuple:
+    """
+    导出整本书，返回 (输出文件路径, 导出章数, 本次重新渲染的章数)。
+    """
+    chapters = sorted(c for c, t in st.session_state.chapter_texts.items() if t.strip())
+    paths, rendered = refresh_chapter_fragments(fmt, chapters)
+    out_path = os.path.join(book_export_dir(), f"book.{fmt}")
+
+    if fmt == "epub":
+        write_epub(out_path, book_title, chapters, paths)
+    else:
+        with open(out_path, "w", encoding="utf-8") as out:
+            out.write(f"# {book_title}\n\n" if fmt == "md" else f"{book_title}\n\n\n")
+            for path in paths:
+                with open(path, encoding="utf-8") as f:
+                    shutil.copyfileobj(f, out)
+    return out_path, len(chapters), rendered
+
+# =============== 字数工具 ===============
+WORD_TARGET_LABELS = ["1500字左右", "2200字左右", "3000字左右", "4000字左右"]
+
+def parse_word_target(label: str):
+    if "1500" in label:
+        return 1300, 1800
+    if "2200" in label:
+        return 1900, 2600
+    if "3000" in label:
+        return 2600, 3400
+    if "4000" in label:
+        return 3500, 4500
+    return 1500, 2500
+
+CJK_RE = re.compile(r"[\u4e00-\u9fff]")
+# 网文字数口径：每个汉字算 1 字，连续的字母/数字算 1 字，标点和空白不计
+# 汉字含扩展 B~G 区（生僻字、人名用字）；全角字母数字和半角一样按连续串算 1 字
+WORD_RE = re.compile(
+    r"[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\U00020000-\U0003134F]"
+    r"|[A-Za-z0-9\uFF10-\uFF19\uFF21-\uFF3A\uFF41-\uFF5A]+"
+)
+
+def rough_char_count(text: str) -> int:
+    return sum(1 for _ in WORD_RE.finditer(text))
+
+# =============== 全书统计索引 ===============
+# 章节正文统一经 set_chapter_text 写入，只重算被改的那一章，总数/阶段/欠字数章节按差值更新。
+STAGE_RANGE_RE = re.compile(r"第?\s*(\d+)\s*章?\s*[-~～—–至到]+\s*第?\s*(\d+)\s*章")
+# “阶段划分”一节结束的标志：不带章节范围的标题行，或者进入了大纲的其他部分
+SECTION_HEADING_RE = re.compile(r"^\s*(#+|【|\*\*|[一二三四五六七八九十]+[、.．])")
+OTHER_SECTION_WORDS = ("章节目录", "伏笔", "角色", "世界观", "概述")
+LIST_MARK_RE = re.compile(r"^\s*(\d+[.、．)]|[一二三四五六七八九十]+、)\s*")
+EMPTY_BRACKETS_RE = re.compile(r"[（(【\[]\s*[)）】\]]")
+TABLE_PIPE_RE = re.compile(r"\s*[|｜]\s*")   # Markdown 表格的单元格分隔
+
+def _clean_stage_name(text: str) -> str:
+    text = TABLE_PIPE_RE.sub(" ", text.replace("阶段划分", ""))
+    text = EMPTY_BRACKETS_RE.sub("", LIST_MARK_RE.sub("", text.strip()))
+    return text.strip(" \t-*#:：;；，,、。（(【[)）】]")
+
+def parse_stage_ranges(outline: str) -> list:
+    """
+    从大纲的“阶段划分”一节抽出 [阶段名, 起始章, 结束章]。
+    “第一卷 觉醒（第1-30章）：主角觉醒” -> ["第一卷 觉醒", 1, 30]，“第一阶段（1-30章）：开局”、
+    表格行“| 起 | 第1-30章 | 开局 |”也认；
+    阶段名在范围前面就取前面，前面是空的（如“- 第1-30章：觉醒篇”）才取后面。
+    """
+    stages = []
+    in_section = False
+    for line in outline.splitlines():
+        m = STAGE_RANGE_RE.search(line)
+        if not in_section:
+            in_section = "阶段划分" in line
+            if not (in_section and m):
+                continue
+        elif not m:
+            if SECTION_HEADING_RE.match(line) or any(w in line for w in OTHER_SECTION_WORDS):
+                break
+            continue
+        start, end = int(m.group(1)), int(m.group(2))
+        name = _clean_stage_name(line[:m.start()]) or _clean_stage_name(line[m.end():])
+        stages.append([name[:16] or f"第{start}-{end}章", start, end])
+    return stages
+
+def stage_for_chapter(idx: dict, chap: int):
+    """本章所在阶段的下标；阶段范围重叠时取第一个。"""
+    for i, (_, start, end) in enumerate(idx["stages"]):
+        if start <= chap <= end:
+            return i
+    return None
+
+def _apply_chapter_delta(idx: dict, chap: int, old: int, new: int):
+    idx["total"] += new - old
+    idx["written"] += (new > 0) - (old > 0)
+    stage = stage_for_chapter(idx, chap)
+    if stage is not None:
+        idx["stage_totals"][stage] += new - old
+    if 0 < new < idx["target"][0]:
+        idx["under_target"][chap] = new
+    else:
+        idx["under_target"].pop(chap, None)
+
+def set_chapter_text(chap: int, text: str, expected_version: int = None) -> bool:
+    """
+    写入章节正文并增量更新统计索引，成功后本章版本号 +1。
+    传入 expected_version 时做乐观锁检查：本章已被别人改过则不写入，返回 False。
+    """
+    with state_lock():
+        texts = st.session_state.chapter_texts
+        versions = st.session_state.text_versions
+        if expected_version is not None and versions.get(chap, 0) != expected_version:
+            return False
+        if texts.get(chap) == text and chap in st.session_state.stats_index["chapters"]:
+            return True
+        texts[chap] = text
+        versions[chap] = versions.get(chap, 0) + 1
+        idx = st.session_state.stats_index
+        old = idx["chapters"].get(chap, 0)
+        new = rough_char_count(text)
+        idx["chapters"][chap] = new
+        _apply_chapter_delta(idx, chap, old, new)
+    if text:
+        notify(f"修改了第{chap}章正文", chap)
+    else:
+        persist()
+    return True
+
+def rebuild_stats_index(recount: bool = False):
+    """
+    导入项目或改了阶段划分/目标字数时整体重建。
+    默认只汇总已缓存的各章字数，recount=True 时才重新数每章的字。
+    """
+    idx = st.session_state.stats_index
+    if recount or set(idx["chapters"]) != set(st.session_state.chapter_texts):
+        idx["chapters"] = {c: rough_char_count(t) for c, t in st.session_state.chapter_texts.items()}
+    counts = idx["chapters"]
+    idx["total"] = 0
+    idx["written"] = 0
+    idx["stage_totals"] = [0] * len(idx["stages"])
+    idx["under_target"] = {}
+    for chap, n in counts.items():
+        _apply_chapter_delta(idx, chap, 0, n)
+
+def sync_stats_config():
+    """大纲/目录变了才重算阶段划分，平时什么都不做。"""
+    with state_lock():
+        _sync_stats_config()
+
+def set_book_target(label: str):
+    """全书单章目标是书的设置：只在有人改了侧边栏选项时写入，然后重算欠字数列表。"""
+    with state_lock():
+        idx = st.session_state.stats_index
+        if idx.get("target_label") == label:
+            return
+        idx["target_label"] = label
+        idx["target"] = list(parse_word_target(label))
+        rebuild_stats_index()
+    notify(f"把全书单章目标改为 {label}")
+
+def _sync_stats_config():
+    idx = st.session_state.stats_index
+    changed = False
+    if idx["outline_src"] != st.session_state.outline_raw:
+        idx["outline_src"] = st.session_state.outline_raw
+        idx["stages"] = parse_stage_ranges(st.session_state.outline_raw)
+        changed = True
+    if idx["list_src"] != st.session_state.outline_chapter_list:
+        idx["list_src"] = st.session_state.outline_chapter_list
+        idx["outline_chapters"] = len(parse_outline_table(st.session_state.outline_chapter_list))
+    if changed:
+        rebuild_stats_index()
+
+def render_stats_dashboard():
+    idx = st.session_state.stats_index
+    sync_stats_config()
+    written = idx["written"]
+    planned = idx["outline_chapters"]
+    c1, c2 = st.columns(2)
+    c1.metric("全书字数", f"{idx['total']:,}")
+    c2.metric("已写章节", f"{written}/{planned}" if planned else str(written))
+    if planned:
+        st.progress(min(1.0, written / planned))
+
+    if idx["stages"]:
+        st.markdown("**分阶段字数**")
+        for (name, start, end), total in zip(idx["stages"], idx["stage_totals"]):
+            st.caption(f"{name}（第{start}-{end}章）：{total:,} 字")
+
+    under = snapshot(idx["under_target"])
+    if under:
+        st.markdown(f"**低于 {idx['target'][0]} 字的章节（{len(under)}）**")
+        st.caption("、".join(f"第{c}章({n})" for c, n in sorted(under.items())[:30])
+                   + ("……" if len(under) > 30 else ""))
+    else:
+        st.caption("已写章节都达到了目标字数下限。")
+
 # =============== 侧边栏：API & 存档 ===============
 with st.sidebar:
     st.title("⚙️ 引擎设置")
@@ -90,6 +676,45 @@ with st.sidebar:
         st.stop()
     client = OpenAI(api_key=api_key, base_url="https://api.siliconflow.cn/v1")
 
+    st.markdown("---")
+    st.subheader("👥 共享工作区")
+    ws_input = st.text_input(
+        "工作区名称（填同一个名字即协作同一本书，留空为个人模式）",
+        value=st.session_state.get("workspace_name") or ""
+    )
+    st.session_state.author_name = st.text_input(
+        "你的署名（用于变更通知）",
+        value=st.session_state.get("author_name", "")
+    )
+    ws_secret = st.text_input("工作区口令（新工作区由第一个加入的人设定，其他成员凭口令加入）", type="password")
+    ws_name = re.sub(r"[^\w\-]", "", ws_input.strip())
+    if not attach_workspace(ws_name, ws_secret):
+        st.error(f"口令为空或不正确，没有加入工作区「{ws_name}」。")
+    ws = current_workspace()
+    if ws:
+        for e in ws.events_since(st.session_state.get("ws_seen_seq", 0), st.session_state.session_id)[-5:]:
+            st.toast(f"👥 {e['author']} {e['what']}")
+        st.session_state.ws_seen_seq = ws.seq
+        st.caption(f"已加入工作区「{ws.name}」，项目数据与其他成员实时共享。")
+        for e in ws.events[-5:][::-1]:
+            stamp = time.strftime("%H:%M", time.localtime(e["ts"]))
+            st.caption(f"{stamp} {e['author']} {e['what']}")
+
+        backup = st.session_state.get("private_backup")
+        if backup:
+            st.warning("加入工作区后编辑的是共享项目；你之前的个人项目已备份，可下载或恢复。")
+            st.download_button(
+                "⬇️ 下载个人项目备份 JSON",
+                data=backup,
+                file_name="novel_project_private_backup.json",
+                mime="application/json",
+            )
+            if st.button("↩️ 退出工作区并恢复个人项目"):
+                attach_workspace("")
+                import_project(backup)
+                st.session_state.private_backup = None
+                st.rerun()
+
     st.markdown("---")
     st.info(
         "推荐流程：\n"
@@ -110,14 +735,54 @@ with st.sidebar:
     )
 
     up = st.file_uploader("⬆️ 导入项目 JSON", type=["json"])
-    if up is not None:
+    # 上传控件在每次刷新都会返回同一个文件，只导入一次，免得反复覆盖共享工作区
+    if up is not None and st.session_state.get("imported_upload") != (up.name, up.size):
         content = up.read().decode("utf-8")
         import_project(content)
+        st.session_state.imported_upload = (up.name, up.size)
         st.success("✅ 导入成功，可在主界面继续写。")
 
+    st.markdown("---")
+    st.subheader("📊 全书进度")
+    # 占位，脚本末尾再填，这样能反映本轮刚写入的章节
+    stats_box = st.container()
+    # 别人改了全书目标时，同步到本会话的选项上（控件渲染前改它的 key 是允许的）
+    book_target = st.session_state.stats_index.get("target_label", WORD_TARGET_LABELS[0])
+    if st.session_state.get("book_target_label") != book_target:
+        st.session_state.book_target_label = book_target
+    st.selectbox(
+        "全书单章目标字数（统计用，全书共用）",
+        WORD_TARGET_LABELS,
+        key="book_target_label",
+        on_change=lambda: set_book_target(st.session_state.book_target_label)
+    )
+
+    st.markdown("---")
+    st.subheader("📖 整本书导出")
+    book_title = st.text_input("书名", value="未命名作品")
+    book_fmt_label = st.selectbox("导出格式", list(BOOK_FORMATS.keys()))
+    book_fmt = BOOK_FORMATS[book_fmt_label]
+    if st.button("📦 生成整本书文件（只重新渲染改动过的章节）"):
+        if not any(t.strip() for t in snapshot(st.session_state.chapter_texts).values()):
+            st.warning("目前还没有任何章节正文。")
+        else:
+            with project_export_lock(st.session_state.project_id), state_lock():
+                out_path, n_chapters, n_rendered = export_book(book_fmt, book_title)
+            st.session_state.book_export_path = out_path
+            st.success(f"✅ 已导出 {n_chapters} 章（本次重新渲染 {n_rendered} 章）。")
+
+    book_path = st.session_state.get("book_export_path")
+    if book_path and book_path.endswith("." + book_fmt) and os.path.exists(book_path):
+        with open(book_path, "rb") as f:
+            st.download_button(
+                f"⬇️ 下载整本书 {book_fmt_label}",
+                data=f,
+                file_name=f"{book_title}.{book_fmt}",
+                mime="application/epub+zip" if book_fmt == "epub" else "text/plain",
+            )
+
 # =============== AI 通用调用 ===============
-def ask_ai(system_role: str, user_prompt: str, temperature: float = 1.0, model: str = "deepseek-ai/DeepSeek-V3"):
-    high_level_rules = """
+HIGH_LEVEL_RULES = """
     【高阶网文写作规范（核心约束）】
     - 禁止模板化套话（如“综上所述”“在这个世界上”“随着时间的推移”等）。
     - 禁止“这一章主要讲了……”这种解说语。
@@ -125,41 +790,316 @@ def ask_ai(system_role: str, user_prompt: str, temperature: float = 1.0, model:
     - 情绪通过动作、对话、细节体现，不写鸡汤式感悟。
     - 世界观自洽，能力系统有代价和限制，伏笔要能回收。
     """
-    system_full = system_role + "\n" + high_level_rules
+
+def call_llm(system_role: str, user_prompt: str, temperature: float = 1.0, model: str = "deepseek-ai/DeepSeek-V3") -> str:
+    """
+    直接请求模型，出错时抛异常。不碰 st.*，可以在线程里调用。
+    """
+    system_full = system_role + "\n" + HIGH_LEVEL_RULES
+    resp = client.chat.completions.create(
+        model=model,
+        messages=[
+            {"role": "system", "content": system_full},
+            {"role": "user", "content": user_prompt}
+        ],
+        temperature=temperature,
+    )
+    return resp.choices[0].message.content or ""
+
+def ask_ai(system_role: str, user_prompt: str, temperature: float = 1.0, model: str = "deepseek-ai/DeepSeek-V3"):
     try:
-        resp = client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": system_full},
-                {"role": "user", "content": user_prompt}
-            ],
-            temperature=temperature,
-        )
-        return resp.choices[0].message.content
+        return call_llm(system_role, user_prompt, temperature, model)
     except Exception as e:
         st.error(f"API Error: {e}")
         return ""
 
-# =============== 字数工具 ===============
-def parse_word_target(label: str):
-    if "1500" in label:
-        return 1300, 1800
-    if "2200" in label:
-        return 1900, 2600
-    if "3000" in label:
-        return 2600, 3400
-    if "4000" in label:
-        return 3500, 4500
-    return 1500, 2500
+DERIVED_CACHE_SIZE = 512
 
-def rough_char_count(text: str) -> int:
-    return len(text.replace("\n", "").replace(" ", ""))
+def ask_ai_derived(system_role: str, user_prompt: str, temperature: float = 1.0, refresh: bool = False):
+    """
+    只用于由已有内容派生出来的结果（如按正文写摘要、从大纲抽目录）：
+    同一工作区里输入完全相同的请求只付一次费。创作类请求不要走这里。
+    个人模式不缓存；refresh=True 时跳过缓存重新请求。
+    """
+    ws = current_workspace()
+    if ws is None:
+        return ask_ai(system_role, user_prompt, temperature)
+    h = prompt_hash(system_role, user_prompt, temperature)
+    if not refresh:
+        with ws.lock:
+            cached = ws.derived.get(h)
+        if cached:
+            return cached
+    out = ask_ai(system_role, user_prompt, temperature)
+    if out:
+        with ws.lock:
+            ws.derived.pop(h, None)
+            ws.derived[h] = out
+            while len(ws.derived) > DERIVED_CACHE_SIZE:
+                ws.derived.pop(next(iter(ws.derived)))
+    return out
+
+def ask_ai_many(system_role: str, user_prompt: str, n: int, temperature: float = 1.0, model: str = "deepseek-ai/DeepSeek-V3") -> list:
+    """
+    并发请求 n 份候选结果，总耗时接近单次请求。
+    失败的那一份返回空字符串，错误在主线程统一提示。
+    """
+    with ThreadPoolExecutor(max_workers=n) as pool:
+        futures = [
+            pool.submit(call_llm, system_role, user_prompt, temperature, model)
+            for _ in range(n)
+        ]
+    results = []
+    for fut in futures:
+        try:
+            results.append(fut.result())
+        except Exception as e:
+            st.error(f"API Error: {e}")
+            results.append("")
+    return results
+
+# =============== 生成日志（断点续跑 + 章节历史版本） ===============
+# 每一次成功的模型输出都追加到本地 JSONL 日志，中途失败/刷新不会丢掉已付费的文本。
+# 每个项目一个目录、每章一个文件；读的时候只解析上次读到之后新追加的行。
+JOURNAL_DIR = "novel_journal"
+
+def journal_path(chap_num: int) -> str:
+    """共享工作区里的成员用同一个 project_id，不同的书互不串台。"""
+    return os.path.join(JOURNAL_DIR, st.session_state.project_id, f"chap_{chap_num:04d}.jsonl")
+
+JOURNAL_PAYLOAD_KEYS = ("output", "text")  # 大段正文不进索引，用到时按位置回文件读
+JOURNAL_INDEX_FILES = 256                   # 索引里最多保留的日志文件数，最久没读的先淘汰
+
+class JournalIndex:
+    """
+    进程级的日志索引：路径 -> 已读到的字节偏移和各条目的元数据。
+    每条只留 type/flow/step/hash 这类小字段，外加它在文件里的 (偏移, 长度)，正文见 journal_payload。
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files = {}
+
+    def read(self, path: str) -> list:
+        with self.lock:
+            cached = self.files.pop(path, None) or {"offset": 0, "entries": []}
+            size = os.path.getsize(path)
+            if size < cached["offset"]:
+                cached = {"offset": 0, "entries": []}  # 文件被截断或替换，从头读
+            if size > cached["offset"]:
+                with open(path, "rb") as f:
+                    f.seek(cached["offset"])
+                    chunk = f.read()
+                end = chunk.rfind(b"\n") + 1  # 写到一半的最后一行留到下次再读
+                pos = 0
+                while pos < end:
+                    nl = chunk.index(b"\n", pos)
+                    try:
+                        entry = json.loads(chunk[pos:nl].decode("utf-8"))
+                    except ValueError:
+                        pos = nl + 1
+                        continue
+                    meta = {k: v for k, v in entry.items() if k not in JOURNAL_PAYLOAD_KEYS}
+                    meta["at"] = (cached["offset"] + pos, nl - pos)
+                    cached["entries"].append(meta)
+                    pos = nl + 1
+                cached["offset"] += end
+            self.files[path] = cached
+            while len(self.files) > JOURNAL_INDEX_FILES:
+                self.files.pop(next(iter(self.files)))
+            return list(cached["entries"])
+
+@st.cache_resource
+def get_journal_index() -> JournalIndex:
+    return JournalIndex()
+
+def prompt_hash(system_role: str, user_prompt: str, temperature: float) -> str:
+    raw = f"{system_role}\n{temperature}\n{user_prompt}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+
+def append_journal(entry: dict):
+    entry = dict(entry, ts=time.time())
+    path = journal_path(entry["chapter"])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    line = (json.dumps(entry, ensure_ascii=False) + "\n").encode("utf-8")
+    with state_lock(), open(path, "ab+") as f:
+        # 上次写到一半就中断的话先补个换行，别把这一条也拼坏
+        if f.seek(0, os.SEEK_END) > 0:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                line = b"\n" + line
+        f.write(line)
+
+def load_journal(chap_num: int) -> list:
+    """读出某一章的全部日志条目（按写入顺序）。"""
+    path = journal_path(chap_num)
+    if not os.path.exists(path):
+        return []
+    return get_journal_index().read(path)
+
+def journal_payload(chap_num: int, entry: dict) -> str:
+    """按索引里记的位置回日志文件，读出这一条的正文（step 的 output，done/title 的 text）。"""
+    offset, size = entry["at"]
+    with open(journal_path(chap_num), "rb") as f:
+        f.seek(offset)
+        full = json.loads(f.read(size).decode("utf-8"))
+    return full.get("output", full.get("text", ""))
+
+def unfinished_flow(chap_num: int, kind: str):
+    """
+    本章同类流程里最后一个没跑完的：返回 (flow_id, 是否明确失败过)，没有则返回 None。
+    最后一条是 step 说明是中途被打断（刷新/崩溃），是 failed 说明有请求出错。
+    """
+    entries = [e for e in load_journal(chap_num) if e.get("kind") == kind]
+    if entries and entries[-1].get("type") in ("step", "failed"):
+        return entries[-1]["flow"], entries[-1]["type"] == "failed"
+    return None
+
+def open_flow(chap_num: int, kind: str, resume: bool = False, flow_id: str = None) -> dict:
+    """
+    开始一次生成流程。
+    上次同类流程没跑完时：用户确认续跑（resume=True）或它明确失败过，就沿用它的 flow_id，
+    已完成的步骤按 prompt 哈希直接复用；否则把它标记为放弃，另起一个新流程。
+    传入 flow_id 时直接接着这个流程跑（挑选草稿时接的是产出这批草稿的那一次，不是最近没跑完的那次）。
+    """
+    flow = {"id": uuid.uuid4().hex, "chapter": chap_num, "kind": kind,
+            "cached": {}, "steps": [], "resumed": False, "failed": False}
+    if flow_id is None:
+        last = unfinished_flow(chap_num, kind)
+        if last is None:
+            return flow
+        flow_id, failed = last
+        if not (resume or failed):
+            append_journal({"type": "abort", "flow": flow_id, "chapter": chap_num, "kind": kind})
+            return flow
+    flow["id"] = flow_id
+    flow["resumed"] = True
+    for e in load_journal(chap_num):
+        if e.get("flow") == flow_id and e.get("type") == "step":
+            output = journal_payload(chap_num, e)
+            flow["cached"].setdefault(e["hash"], []).append(output)
+            flow["steps"].append((e["step"], output))
+    return flow
+
+def journaled_ask(flow: dict, step: str, system_role: str, user_prompt: str, temperature: float = 1.0, derived: bool = False) -> str:
+    h = prompt_hash(system_role, user_prompt, temperature)
+    cached = flow["cached"].get(h)
+    if cached:
+        return cached.pop(0)
+    out = (ask_ai_derived if derived else ask_ai)(system_role, user_prompt, temperature)
+    if out:
+        append_journal({"type": "step", "flow": flow["id"], "chapter": flow["chapter"],
+                        "kind": flow["kind"], "step": step, "hash": h, "output": out})
+    else:
+        flow["failed"] = True
+    return out
+
+def journaled_ask_many(flow: dict, step: str, system_role: str, user_prompt: str, n: int, temperature: float = 1.0) -> list:
+    """并发版：日志里已有的份数直接复用，只补请求缺的那几份。"""
+    h = prompt_hash(system_role, user_prompt, temperature)
+    cached = flow["cached"].pop(h, [])[:n]
+    missing = n - len(cached)
+    fresh = ask_ai_many(system_role, user_prompt, missing, temperature) if missing else []
+    for out in fresh:
+        if out:
+            append_journal({"type": "step", "flow": flow["id"], "chapter": flow["chapter"],
+                            "kind": flow["kind"], "step": step, "hash": h, "output": out})
+        else:
+            flow["failed"] = True
+    return cached + fresh
+
+def close_flow(flow: dict, final_text: str):
+    """
+    流程全部成功才落一个 done 条目，它同时是本章的一个历史版本；
+    有步骤失败则落一个 failed 条目，下次同类流程会自动接着它跑。
+    """
+    if flow["failed"]:
+        append_journal({"type": "failed", "flow": flow["id"], "chapter": flow["chapter"], "kind": flow["kind"]})
+        return
+    append_journal({"type": "done", "flow": flow["id"], "chapter": flow["chapter"],
+                    "kind": flow["kind"], "text": final_text})
+
+def journal_title(chap_num: int) -> str:
+    """日志里记下的本章标题（存档没来得及导出时，刷新后靠它保持标题不变）。"""
+    titles = [e for e in load_journal(chap_num) if e.get("type") == "title"]
+    return journal_payload(chap_num, titles[-1]) if titles else ""
+
+def chapter_versions(chap_num: int) -> list:
+    """本章所有已完成生成流程的成稿，新的在前，用作撤销历史。"""
+    versions = [e for e in load_journal(chap_num) if e.get("type") == "done"]
+    return [dict(e, text=journal_payload(chap_num, e)) for e in versions[::-1]]
+
+# =============== 草稿本地评分（不调用 API） ===============
+
+def length_fit(n_chars: int, min_words: int, max_words: int) -> float:
+    """落在目标区间内得 1 分，偏短/偏长按比例扣分。"""
+    if n_chars <= 0:
+        return 0.0
+    if n_chars < min_words:
+        return n_chars / min_words
+    if n_chars > max_words:
+        return max_words / n_chars
+    return 1.0
+
+def repetition_ratio(text: str, n: int = 4) -> float:
+    """重复的 n 字片段占比，越高说明车轱辘话越多。"""
+    compact = "".join(text.split())
+    total = len(compact) - n + 1
+    if total <= 0:
+        return 0.0
+    grams = {compact[i:i + n] for i in range(total)}
+    return 1 - len(grams) / total
+
+PLAN_OUTLINE_PREFIX = "基于目录行："
+DEFAULT_PLAN_LINES = (
+    "本章需要至少完成以下几点（你可以在此基础上修改）：",
+    "1. 用一个具体场景或事件直接引出本章的核心矛盾。",
+    "2. 推进至少一个重要人物关系或阵营矛盾，让局势发生可感知变化。",
+    "3. 为下一章埋下一个明确的悬念或伏笔（细节形式表现）。",
+)
+
+def plan_scoring_text(outline_line: str, plan: str) -> str:
+    """算大纲覆盖率用的文本：目录行 + 作者自己写的细纲，默认细纲里的通用套话不算。"""
+    lines = [outline_line]
+    for line in plan.splitlines():
+        line = line.strip()
+        if line.startswith(PLAN_OUTLINE_PREFIX):
+            line = line[len(PLAN_OUTLINE_PREFIX):].strip()
+        if line and line not in DEFAULT_PLAN_LINES and line != outline_line:
+            lines.append(line)
+    return "\n".join(lines)
+
+def plan_keyword_coverage(text: str, plan: str) -> float:
+    """本章大纲里的中文二字片段，有多少在正文里出现过。"""
+    chars = [c if CJK_RE.match(c) else " " for c in plan]
+    keywords = set()
+    for seg in "".join(chars).split():
+        for i in range(len(seg) - 1):
+            keywords.add(seg[i:i + 2])
+    if not keywords:
+        return 0.0
+    hit = sum(1 for kw in keywords if kw in text)
+    return hit / len(keywords)
+
+def score_draft(text: str, plan: str, min_words: int, max_words: int) -> dict:
+    n_chars = rough_char_count(text)
+    fit = length_fit(n_chars, min_words, max_words)
+    rep = repetition_ratio(text)
+    cov = plan_keyword_coverage(text, plan)
+    score = 0.4 * fit + 0.3 * max(0.0, 1 - rep * 2) + 0.3 * cov
+    return {
+        "chars": n_chars,
+        "length_fit": fit,
+        "repetition": rep,
+        "coverage": cov,
+        "score": round(score * 100, 1),
+    }
 
 # =============== 剧情记忆库相关函数 ===============
 
-def auto_summary_for_chapter(chap_num: int, chapter_text: str) -> str:
+def auto_summary_for_chapter(chap_num: int, chapter_text: str, flow: dict = None, refresh: bool = False) -> str:
     """
     自动生成某一章的剧情摘要，用于记忆库。
+    传入 flow 时结果会记入生成日志；refresh=True 时不用工作区缓存。
     """
     prompt = f"""
     你是一名网文主编，请为下面这一章正文生成一份【剧情摘要】，用于后续章节写作时参考。
@@ -178,7 +1118,10 @@ def auto_summary_for_chapter(chap_num: int, chapter_text: str) -> str:
 
     只输出摘要内容本身。
     """
-    summary = ask_ai("资深网文主编", prompt, temperature=0.6)
+    if flow is not None:
+        summary = journaled_ask(flow, "summary", "资深网文主编", prompt, temperature=0.6, derived=True)
+    else:
+        summary = ask_ai_derived("资深网文主编", prompt, temperature=0.6, refresh=refresh)
     return summary or ""
 
 def build_memory_context(current_chap_num: int, max_recent: int = 3, max_chars: int = 1800) -> str:
@@ -187,7 +1130,7 @@ def build_memory_context(current_chap_num: int, max_recent: int = 3, max_chars:
     包含：全局摘要（如果有） + 最近几章的摘要。
     """
     memory = st.session_state.story_memory
-    chapter_summaries = memory.get("chapter_summaries", {})
+    chapter_summaries = snapshot(memory.get("chapter_summaries", {}))
     global_summary = memory.get("global_summary", "").strip()
 
     parts = []
@@ -334,7 +1277,7 @@ if tool.startswith("1"):
                         temperature=1.0
                     )
                     if outline_full:
-                        st.session_state.outline_raw = outline_full
+                        set_shared_value("outline_raw", outline_full)
 
                         extract_prompt = f"""
                         从下面大纲中，只抽取【章节目录部分】，并保证章节号从第1章连续到第{target_chapters}章：
@@ -348,23 +1291,23 @@ if tool.startswith("1"):
                         - 如果在原文中没有找到某一章的详细描述，你也要根据上下文合理补全这一章的标题和简介。
                         - 不要输出额外解释，只输出多行目录文本。
                         """
-                        chapter_list = ask_ai(
+                        chapter_list = ask_ai_derived(
                             "你是负责整理章节目录的编辑助理。",
                             extract_prompt,
                             temperature=0.4
                         )
-                        st.session_state.outline_chapter_list = chapter_list
+                        set_shared_value("outline_chapter_list", chapter_list)
                         st.success("✅ 大纲生成完成，章节目录已解析。右侧可查看。")
 
     with right:
         tabs = st.tabs(["大纲全文", "章节目录"])
         with tabs[0]:
             st.subheader("大纲全文（可手动精修）")
-            st.session_state.outline_raw = st.text_area(
+            set_shared_value("outline_raw", st.text_area(
                 "完整大纲：",
                 height=620,
                 value=st.session_state.outline_raw
-            )
+            ))
         with tabs[1]:
             st.subheader("章节目录（第X章 …… —— 简介）")
             st.text_area(
@@ -393,20 +1336,14 @@ elif tool.startswith("2"):
         chap_num = int(chap_num)
 
         def get_outline_line_for_chapter(chap: int) -> str:
-            outline = st.session_state.outline_chapter_list or ""
-            for line in outline.splitlines():
-                line = line.strip()
-                if not line:
-                    continue
-                if line.startswith(f"第{chap}章"):
-                    return line
-            return ""
+            return parse_outline_table(st.session_state.outline_chapter_list or "").get(chap, "")
 
         outline_line = get_outline_line_for_chapter(chap_num)
 
-        # 自动标题
-        auto_title = ""
-        if outline_line:
+        # 自动标题：每章只拟一次，存进项目数据和生成日志。
+        # 标题会进正文 prompt，换了标题日志里的 prompt 哈希就对不上，断点续跑会失效。
+        auto_title = st.session_state.chapter_titles.get(chap_num) or journal_title(chap_num)
+        if outline_line and not auto_title:
             title_prompt = f"""
             根据下面这条章节目录信息，给这一章拟一个简洁但有吸引力的【中文章节标题】：
 
@@ -423,11 +1360,15 @@ elif tool.startswith("2"):
                 title_prompt,
                 temperature=0.9
             ).strip()
+            if auto_title:
+                append_journal({"type": "title", "chapter": chap_num, "text": auto_title})
 
         chapter_title = st.text_input(
             "章节标题（可手动修改，AI会给一个默认）",
             value=auto_title if auto_title else ""
         )
+        if chapter_title != st.session_state.chapter_titles.get(chap_num, ""):
+            _set_entry(st.session_state.chapter_titles, chap_num, chapter_title, f"修改了第{chap_num}章标题", chap_num)
 
         # 本章大纲
         plan_key = f"chapter_plan_{chap_num}"
@@ -436,13 +1377,7 @@ elif tool.startswith("2"):
             base_line = get_outline_line_for_chapter(chap)
             if not base_line:
                 return ""
-            return (
-                f"基于目录行：{base_line}\n"
-                "本章需要至少完成以下几点（你可以在此基础上修改）：\n"
-                "1. 用一个具体场景或事件直接引出本章的核心矛盾。\n"
-                "2. 推进至少一个重要人物关系或阵营矛盾，让局势发生可感知变化。\n"
-                "3. 为下一章埋下一个明确的悬念或伏笔（细节形式表现）。"
-            )
+            return "\n".join((PLAN_OUTLINE_PREFIX + base_line,) + DEFAULT_PLAN_LINES)
 
         if plan_key not in st.session_state:
             st.session_state[plan_key] = build_default_plan(chap_num)
@@ -460,17 +1395,26 @@ elif tool.startswith("2"):
         )
         word_target_label = st.selectbox(
             "本次生成/续写目标字数（单轮目标）",
-            ["1500字左右", "2200字左右", "3000字左右", "4000字左右"]
+            WORD_TARGET_LABELS
         )
         min_words, max_words = parse_word_target(word_target_label)
+        draft_count = int(st.number_input(
+            "并行草稿数（大于 1 时同时生成多份初稿，本地打分后并排挑选）",
+            min_value=1,
+            max_value=4,
+            value=1,
+            step=1
+        ))
+        drafts_key = f"chapter_drafts_{chap_num}"
 
+        sync_stats_config()
         if chap_num not in st.session_state.chapter_texts:
-            st.session_state.chapter_texts[chap_num] = ""
+            set_chapter_text(chap_num, "")
         if chap_num not in st.session_state.chapter_highlights:
             st.session_state.chapter_highlights[chap_num] = ""
 
         # ===== 封装：追加续写（带记忆库） =====
-        def ai_continue_chapter(existing: str, extra_min: int, extra_max: int) -> str:
+        def ai_continue_chapter(existing: str, extra_min: int, extra_max: int, flow: dict = None) -> str:
             tail = existing[-1200:] if existing else ""
             memory_block = build_memory_context(chap_num)
 
@@ -503,12 +1447,81 @@ elif tool.startswith("2"):
 
             只输出【新增的续写正文】部分，不要重复前文。
             """
+            if flow is not None:
+                return journaled_ask(
+                    flow,
+                    "continue",
+                    "你是在延续自己作品的作者，非常在意逻辑连续、世界观自洽和伏笔回收。",
+                    cont_prompt,
+                    temperature=1.05
+                )
             return ask_ai(
                 "你是在延续自己作品的作者，非常在意逻辑连续、世界观自洽和伏笔回收。",
                 cont_prompt,
                 temperature=1.05
             )
 
+        def rank_drafts(texts: list) -> list:
+            scoring_plan = plan_scoring_text(outline_line, chapter_plan)
+            drafts = [
+                dict(text=t, **score_draft(t, scoring_plan, min_words, max_words))
+                for t in texts if t.strip()
+            ]
+            drafts.sort(key=lambda d: d["score"], reverse=True)
+            return drafts
+
+        # ===== 封装：以一份初稿为底，追字数 + 写记忆 + 提亮点 =====
+        def finish_chapter(base_text: str, flow: dict):
+            combined = base_text
+            # 自动追字数：最多续写3轮
+            for _ in range(3):
+                curr_len = rough_char_count(combined)
+                if curr_len >= min_words:
+                    break
+                extra_min = max(800, min_words - curr_len)
+                extra_max = extra_min + 600
+                extra = ai_continue_chapter(combined, extra_min, extra_max, flow) or ""
+                if not extra.strip():
+                    break
+                combined = combined + "\n\n" + extra
+                set_chapter_text(chap_num, combined)
+
+            set_chapter_text(chap_num, combined)
+            st.session_state.last_chapter = chap_num
+
+            # ==== 自动生成剧情摘要，写入记忆库 ====
+            chap_summary = auto_summary_for_chapter(chap_num, combined, flow)
+            set_chapter_summary(chap_num, chap_summary)
+
+            # 提炼本章亮点
+            hl_prompt = f"""
+            下面是一章小说正文，请你用编辑视角提炼本章的【看点亮点】，用于写推文和单章导语：
+
+            {combined}
+
+            要求：
+            - 总结 3~6 条亮点。
+            - 每条不超过 40 字。
+            - 重点突出：冲突、反转、高光台词/行为、人物张力、设定脑洞。
+            - 不要剧透后续剧情，只聚焦本章已出现的内容。
+            只输出亮点列表，每行一条。
+            """
+            highlights = journaled_ask(
+                flow,
+                "highlights",
+                "你是负责卖点包装的网文责编。",
+                hl_prompt,
+                temperature=0.9
+            )
+            set_chapter_highlight(chap_num, highlights or "")
+
+            close_flow(flow, combined)
+            if flow["failed"]:
+                st.warning("部分步骤请求失败，已完成的部分已写入生成日志，再次生成时会直接复用。")
+                return
+            final_len = rough_char_count(combined)
+            st.success(f"✅ 本章正文已生成（估算字数：约 {final_len} 字），剧情摘要已写入记忆库，亮点已提炼。右侧可查看和微调。")
+
         # ===== 生成 / 重写本章 =====
         if st.button("✍️ 高质量生成 / 重写本章（自动追字数 + 记录记忆）", use_container_width=True):
             if not chapter_plan.strip():
@@ -547,54 +1560,90 @@ elif tool.startswith("2"):
 
                     只输出这一章的【正文内容】，不要额外解释。
                     """
-                    base_text = ask_ai(
-                        "你是一名非常熟练、会控节奏和伏笔的网文作者。",
-                        gen_prompt,
-                        temperature=1.1
-                    ) or ""
-
-                    combined = base_text
-                    # 自动追字数：最多续写3轮
-                    for _ in range(3):
-                        curr_len = rough_char_count(combined)
-                        if curr_len >= min_words:
-                            break
-                        extra_min = max(800, min_words - curr_len)
-                        extra_max = extra_min + 600
-                        extra = ai_continue_chapter(combined, extra_min, extra_max) or ""
-                        if not extra.strip():
-                            break
-                        combined = combined + "\n\n" + extra
-
-                    st.session_state.chapter_texts[chap_num] = combined
-                    st.session_state.last_chapter = chap_num
-
-                    # ==== 自动生成剧情摘要，写入记忆库 ====
-                    chap_summary = auto_summary_for_chapter(chap_num, combined)
-                    st.session_state.story_memory["chapter_summaries"][chap_num] = chap_summary
-
-                    # 提炼本章亮点
-                    hl_prompt = f"""
-                    下面是一章小说正文，请你用编辑视角提炼本章的【看点亮点】，用于写推文和单章导语：
-
-                    {combined}
-
-                    要求：
-                    - 总结 3~6 条亮点。
-                    - 每条不超过 40 字。
-                    - 重点突出：冲突、反转、高光台词/行为、人物张力、设定脑洞。
-                    - 不要剧透后续剧情，只聚焦本章已出现的内容。
-                    只输出亮点列表，每行一条。
-                    """
-                    highlights = ask_ai(
-                        "你是负责卖点包装的网文责编。",
-                        hl_prompt,
-                        temperature=0.9
+                    flow = open_flow(chap_num, "generate")
+                    if flow["resumed"]:
+                        st.info("本章上次生成有步骤失败，已完成的步骤直接复用日志，不再重复请求。")
+                    if draft_count == 1:
+                        base_text = journaled_ask(
+                            flow,
+                            "draft",
+                            "你是一名非常熟练、会控节奏和伏笔的网文作者。",
+                            gen_prompt,
+                            temperature=1.1
+                        )
+                        st.session_state.pop(drafts_key, None)
+                        if not base_text.strip():
+                            close_flow(flow, "")
+                            st.warning("初稿生成失败，请稍后重试。")
+                        else:
+                            finish_chapter(base_text, flow)
+                    else:
+                        texts = journaled_ask_many(
+                            flow,
+                            "draft",
+                            "你是一名非常熟练、会控节奏和伏笔的网文作者。",
+                            gen_prompt,
+                            draft_count,
+                            temperature=1.1
+                        )
+                        if flow["failed"]:
+                            close_flow(flow, "")
+                        drafts = rank_drafts(texts)
+                        st.session_state[drafts_key] = {"flow": flow["id"], "drafts": drafts}
+                        if drafts:
+                            st.success(f"✅ 已并行生成 {len(drafts)} 份草稿，按本地评分从高到低排列，请在下方挑选。")
+
+        # ===== 上次被打断的生成：由用户决定是否续跑 =====
+        has_drafts = bool((st.session_state.get(drafts_key) or {}).get("drafts"))
+        pending = None if has_drafts else unfinished_flow(chap_num, "generate")
+        if pending:
+            st.info("本章有一次未完成的生成（可能是页面刷新或中途出错），已付费的结果都在日志里。")
+            c1, c2 = st.columns(2)
+            if c1.button("⏯️ 从断点继续", key=f"flow_resume_{chap_num}", use_container_width=True):
+                flow = open_flow(chap_num, "generate", resume=True)
+                draft_texts = [out for step, out in flow["steps"] if step == "draft"]
+                if len(draft_texts) > 1:
+                    # 多稿流程：把草稿恢复出来重新挑，不替用户选
+                    st.session_state[drafts_key] = {"flow": flow["id"], "drafts": rank_drafts(draft_texts)}
+                    st.rerun()
+                elif draft_texts:
+                    with st.spinner("正在从断点继续……"):
+                        finish_chapter(draft_texts[0], flow)
+                else:
+                    append_journal({"type": "abort", "flow": flow["id"], "chapter": chap_num, "kind": "generate"})
+                    st.warning("上次生成连初稿都没有完成，请直接重新生成。")
+            if c2.button("🗑️ 丢弃，不再续跑", key=f"flow_discard_{chap_num}", use_container_width=True):
+                append_journal({"type": "abort", "flow": pending[0], "chapter": chap_num, "kind": "generate"})
+                st.rerun()
+
+        # ===== 多稿并排挑选 =====
+        # {"flow": 产出这批草稿的流程 id, "drafts": [...]}
+        draft_set = st.session_state.get(drafts_key) or {"flow": None, "drafts": []}
+        drafts = draft_set["drafts"]
+        if drafts:
+            st.markdown("**候选草稿（本地评分：字数贴合 / 重复度 / 大纲覆盖）**")
+            cols = st.columns(len(drafts))
+            for idx, (col, draft) in enumerate(zip(cols, drafts)):
+                with col:
+                    st.metric(f"草稿 {idx + 1}", f"{draft['score']} 分")
+                    st.caption(
+                        f"约 {draft['chars']} 字 · 字数贴合 {draft['length_fit']:.0%} · "
+                        f"重复 {draft['repetition']:.0%} · 大纲覆盖 {draft['coverage']:.0%}"
                     )
-                    st.session_state.chapter_highlights[chap_num] = highlights or ""
-
-                    final_len = rough_char_count(combined)
-                    st.success(f"✅ 本章正文已生成（估算字数：约 {final_len} 字），剧情摘要已写入记忆库，亮点已提炼。右侧可查看和微调。")
+                    st.text_area(
+                        f"草稿 {idx + 1} 预览",
+                        height=300,
+                        value=draft["text"],
+                        disabled=True
+                    )
+                    if st.button(f"采用草稿 {idx + 1}", key=f"draft_pick_{chap_num}_{idx}", use_container_width=True):
+                        with st.spinner("正在以该草稿为底补足字数并记录记忆……"):
+                            st.session_state.pop(drafts_key, None)
+                            finish_chapter(draft["text"], open_flow(chap_num, "generate", flow_id=draft_set["flow"]))
+            if st.button("🗑️ 放弃全部草稿", key=f"draft_discard_{chap_num}"):
+                st.session_state.pop(drafts_key, None)
+                append_journal({"type": "abort", "flow": draft_set["flow"], "chapter": chap_num, "kind": "generate"})
+                st.rerun()
 
         # ===== 手动追加续写 =====
         if st.button("➕ 在现有基础上增加一轮高质量续写（带记忆）", use_container_width=True):
@@ -603,66 +1652,116 @@ elif tool.startswith("2"):
                 st.warning("本章目前还没有正文，请先生成或手写一点内容。")
             else:
                 with st.spinner("正在追加一轮续写……"):
-                    extra = ai_continue_chapter(base, min_words, max_words) or ""
+                    flow = open_flow(chap_num, "continue")
+                    extra = ai_continue_chapter(base, min_words, max_words, flow) or ""
                     combined = base + ("\n\n" + extra if extra.strip() else "")
-                    st.session_state.chapter_texts[chap_num] = combined
-                    st.session_state.last_chapter = chap_num
+                    if extra.strip():
+                        set_chapter_text(chap_num, combined)
+                        st.session_state.last_chapter = chap_num
 
-                    # 更新本章摘要
-                    chap_summary = auto_summary_for_chapter(chap_num, combined)
-                    st.session_state.story_memory["chapter_summaries"][chap_num] = chap_summary
+                        # 更新本章摘要
+                        chap_summary = auto_summary_for_chapter(chap_num, combined, flow)
+                        set_chapter_summary(chap_num, chap_summary)
 
-                    # 更新亮点
-                    hl_prompt2 = f"""
-                    下面是一整章小说正文，请你重新提炼本章的【看点亮点】：
+                        # 更新亮点
+                        hl_prompt2 = f"""
+                        下面是一整章小说正文，请你重新提炼本章的【看点亮点】：
 
-                    {combined}
+                        {combined}
 
-                    要求同前：
-                    - 3~6 条亮点，每条不超过40字，突出冲突/反转/高光。
-                    - 不要剧透后续剧情。
-                    """
-                    highlights2 = ask_ai(
-                        "你是负责卖点包装的网文责编。",
-                        hl_prompt2,
-                        temperature=0.9
-                    )
-                    st.session_state.chapter_highlights[chap_num] = highlights2 or st.session_state.chapter_highlights.get(chap_num, "")
-
-                    final_len = rough_char_count(combined)
-                    st.success(f"✅ 续写已完成（估算字数：约 {final_len} 字），剧情摘要和亮点已更新。")
+                        要求同前：
+                        - 3~6 条亮点，每条不超过40字，突出冲突/反转/高光。
+                        - 不要剧透后续剧情。
+                        """
+                        highlights2 = journaled_ask(
+                            flow,
+                            "highlights",
+                            "你是负责卖点包装的网文责编。",
+                            hl_prompt2,
+                            temperature=0.9
+                        )
+                        if highlights2:
+                            set_chapter_highlight(chap_num, highlights2)
+
+                    close_flow(flow, combined)
+                    if flow["failed"]:
+                        st.warning("部分步骤请求失败，已完成的部分已写入生成日志，再次生成时会直接复用。")
+                    elif not extra.strip():
+                        st.info("这一轮没有续写出新内容，正文、摘要和亮点都没有改动。")
+                    else:
+                        final_len = rough_char_count(combined)
+                        st.success(f"✅ 续写已完成（估算字数：约 {final_len} 字），剧情摘要和亮点已更新。")
 
     with right:
         st.subheader(f"第 {chap_num} 章 · 正文与亮点")
 
-        curr_text = st.session_state.chapter_texts.get(chap_num, "")
+        # 编辑框记住自己载入的是哪个版本：版本没变才把改动写回去，
+        # 期间被别人（或生成流程）改过且本地也有未保存改动时，交给用户选。
+        editor_key = f"chapter_editor_{chap_num}"
+        loaded_key = f"chapter_loaded_{chap_num}"
+        shared_text = st.session_state.chapter_texts.get(chap_num, "")
+        shared_ver = st.session_state.text_versions.get(chap_num, 0)
+        loaded_ver, loaded_text = st.session_state.get(loaded_key, (None, None))
+        if loaded_ver != shared_ver:
+            if editor_key not in st.session_state or st.session_state[editor_key] == loaded_text:
+                st.session_state[editor_key] = shared_text
+                st.session_state[loaded_key] = (shared_ver, shared_text)
+                loaded_ver, loaded_text = shared_ver, shared_text
+            else:
+                st.warning("⚠️ 本章正文已被其他成员修改，你这边还有未保存的改动。")
+                c1, c2 = st.columns(2)
+                if c1.button("载入最新版本（放弃我的改动）", key=f"conflict_theirs_{chap_num}", use_container_width=True):
+                    st.session_state[editor_key] = shared_text
+                    st.session_state[loaded_key] = (shared_ver, shared_text)
+                    loaded_ver, loaded_text = shared_ver, shared_text
+                if c2.button("用我的版本覆盖", key=f"conflict_mine_{chap_num}", use_container_width=True):
+                    mine = st.session_state[editor_key]
+                    if set_chapter_text(chap_num, mine, expected_version=shared_ver):
+                        loaded_ver = st.session_state.text_versions.get(chap_num, 0)
+                        loaded_text = mine
+                        st.session_state[loaded_key] = (loaded_ver, loaded_text)
+
         new_text = st.text_area(
             "章节正文（可自由编辑，生成/续写也会更新这里）",
             height=460,
-            value=curr_text
+            key=editor_key
         )
-        st.session_state.chapter_texts[chap_num] = new_text
+        if new_text != loaded_text and loaded_ver == shared_ver:
+            if set_chapter_text(chap_num, new_text, expected_version=loaded_ver):
+                st.session_state[loaded_key] = (st.session_state.text_versions.get(chap_num, 0), new_text)
+            else:
+                st.warning("⚠️ 保存时发现本章刚被其他成员修改，请处理冲突后再保存。")
 
-        curr_len = rough_char_count(new_text)
+        curr_len = st.session_state.stats_index["chapters"].get(chap_num, 0)
         st.caption(f"当前估算字数：约 {curr_len} 字")
 
         st.markdown("**本章亮点 / 看点摘要（可用来写推文、导语）**")
-        hl_text = st.text_area(
+        synced_text_area(
             "自动提炼的亮点（可手工修改，不影响正文）",
-            height=100,
-            value=st.session_state.chapter_highlights.get(chap_num, "")
+            key=f"highlights_edit_{chap_num}",
+            current=st.session_state.chapter_highlights.get(chap_num, ""),
+            on_edit=lambda v, c=chap_num: set_chapter_highlight(c, v),
+            height=100
         )
-        st.session_state.chapter_highlights[chap_num] = hl_text
 
         # 显示/编辑本章剧情摘要（来自记忆库）
         st.markdown("**本章剧情摘要（记忆库条目，可修改）**")
-        curr_summary = st.session_state.story_memory["chapter_summaries"].get(chap_num, "")
-        new_summary = st.text_area(
+        synced_text_area(
             "剧情摘要（强烈建议保持精简准确，用于后续章节逻辑参考）",
-            height=140,
-            value=curr_summary
+            key=f"summary_main_{chap_num}",
+            current=st.session_state.story_memory["chapter_summaries"].get(chap_num, ""),
+            on_edit=lambda v, c=chap_num: set_chapter_summary(c, v),
+            height=140
         )
-        st.session_state.story_memory["chapter_summaries"][chap_num] = new_summary
+        if st.button("🔄 按当前正文重新生成本章摘要", key=f"resummarize_{chap_num}"):
+            if not new_text.strip():
+                st.warning("本章目前还没有正文。")
+            else:
+                with st.spinner("正在重新生成本章摘要……"):
+                    summary = auto_summary_for_chapter(chap_num, new_text, refresh=True)
+                if summary:
+                    set_chapter_summary(chap_num, summary)
+                    st.rerun()
 
         st.download_button(
             "💾 导出本章正文 TXT",
@@ -672,6 +1771,19 @@ elif tool.startswith("2"):
             use_container_width=True
         )
 
+        # 生成日志里的历史成稿，可一键回退
+        versions = chapter_versions(chap_num)
+        if versions:
+            with st.expander(f"🕘 本章历史版本（共 {len(versions)} 个，来自生成日志）"):
+                for i, v in enumerate(versions):
+                    stamp = time.strftime("%m-%d %H:%M", time.localtime(v["ts"]))
+                    label = "生成" if v.get("kind") == "generate" else "续写"
+                    st.caption(f"{stamp} · {label} · 约 {rough_char_count(v['text'])} 字")
+                    st.text(v["text"][:120] + ("……" if len(v["text"]) > 120 else ""))
+                    if st.button("↩️ 恢复此版本", key=f"restore_{chap_num}_{i}"):
+                        set_chapter_text(chap_num, v["text"])
+                        st.rerun()
+
 # ======================================================
 # 3. 剧情记忆库面板 —— 查看 & 手改全局摘要
 # ======================================================
@@ -679,7 +1791,7 @@ elif tool.startswith("3"):
     st.header("3️⃣ 剧情记忆库 · 总览与维护")
 
     memory = st.session_state.story_memory
-    chapter_summaries = memory.get("chapter_summaries", {})
+    chapter_summaries = snapshot(memory.get("chapter_summaries", {}))
     global_summary = memory.get("global_summary", "")
 
     colA, colB = st.columns([1, 1])
@@ -687,12 +1799,13 @@ elif tool.startswith("3"):
     with colA:
         st.subheader("📌 全局剧情/设定摘要（喂给后续所有章节看的）")
         st.caption("建议你不定期手工调整，让它始终概括到当前进度的“真相”。")
-        new_global = st.text_area(
+        synced_text_area(
             "全局摘要（例如：世界观、主线进度、主要势力关系等）",
-            height=300,
-            value=global_summary
+            key="global_summary_edit",
+            current=global_summary,
+            on_edit=set_global_summary,
+            height=300
         )
-        st.session_state.story_memory["global_summary"] = new_global
 
         if st.button("🧠 让 AI 帮我根据已写章节自动生成全局摘要", use_container_width=True):
             if not st.session_state.chapter_texts:
@@ -701,9 +1814,10 @@ elif tool.startswith("3"):
                 with st.spinner("正在根据已写章节生成全局摘要……"):
                     # 把所有已有章节正文简单拼起来截断
                     all_text = ""
-                    for chap in sorted(st.session_state.chapter_texts.keys()):
+                    texts = snapshot(st.session_state.chapter_texts)
+                    for chap in sorted(texts.keys()):
                         all_text += f"【第{chap}章】\n"
-                        all_text += st.session_state.chapter_texts[chap] + "\n\n"
+                        all_text += texts[chap] + "\n\n"
                     all_text = all_text[:8000]
 
                     prompt = f"""
@@ -720,7 +1834,7 @@ elif tool.startswith("3"):
                     只输出摘要内容本身。
                     """
                     gs = ask_ai("资深网文主编", prompt, 0.7)
-                    st.session_state.story_memory["global_summary"] = gs or ""
+                    set_global_summary(gs or "")
                     st.success("✅ 全局摘要已生成并写入记忆库。")
 
     with colB:
@@ -731,19 +1845,19 @@ elif tool.startswith("3"):
             # 按章节号排序展示
             for chap in sorted(chapter_summaries.keys()):
                 with st.expander(f"第 {chap} 章 摘要"):
-                    txt = st.text_area(
+                    synced_text_area(
                         f"第{chap}章 摘要编辑框",
-                        height=150,
-                        value=chapter_summaries[chap],
-                        key=f"summary_edit_{chap}"
+                        key=f"summary_edit_{chap}",
+                        current=chapter_summaries[chap],
+                        on_edit=lambda v, c=chap: set_chapter_summary(c, v),
+                        height=150
                     )
-                    st.session_state.story_memory["chapter_summaries"][chap] = txt
 
     # 底部导出记忆库
     st.markdown("---")
     if st.button("📤 导出剧情记忆库 JSON（只包含摘要，不含正文）"):
         mem_export = {
-            "chapter_summaries": {str(k): v for k, v in st.session_state.story_memory.get("chapter_summaries", {}).items()},
+            "chapter_summaries": {str(k): v for k, v in snapshot(st.session_state.story_memory.get("chapter_summaries", {})).items()},
             "global_summary": st.session_state.story_memory.get("global_summary", "")
         }
         st.download_button(
@@ -753,3 +1867,7 @@ elif tool.startswith("3"):
             mime="application/json",
             use_container_width=True
         )
+
+# =============== 侧边栏统计面板（放在最后渲染，反映本轮的写入） ===============
+with stats_box:
+    render_stats_dashboard()